@@ -5,16 +5,36 @@ Script per generare CSV delle campagne Brevo
 Sincronizza i dati da Brevo a un file CSV o direttamente a NocoDB
 """
 
+import io
 import os
 import json
 import requests
 import csv
 from datetime import datetime
 
-# Carica configurazione
-CONFIG_FILE = '/Users/francesconguyen/brevo-nocodb-config.json'
-with open(CONFIG_FILE, 'r') as f:
-    CONFIG = json.load(f)
+# orjson (parser JSON in C) se disponibile, altrimenti stdlib
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# pandas (opzionale): percorso vettorizzato per export molto grandi
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+# Sopra questa soglia di campagne conviene il percorso pandas
+_VECTORIZE_THRESHOLD = 1000
+
+# Prefisso URL delle campagne (costante di modulo: niente f-string per riga)
+_URL_PREFIX = "https://app.brevo.com/campaigns/"
+
+# Carica configurazione dal modulo condiviso (parse memoizzato)
+from brevo_config import get_config
+
+CONFIG = get_config()
 
 # Configurazione
 BREVO_API_KEY = os.getenv("BREVO_API_KEY", CONFIG['brevo']['fallback_api_key'])
@@ -30,6 +50,11 @@ class BrevoClient:
             'api-key': api_key,
             'Content-Type': 'application/json'
         }
+        # Session con connection pooling: riusa la connessione TCP/TLS
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        self.session.mount('https://', requests.adapters.HTTPAdapter(
+            pool_connections=10, pool_maxsize=20))
 
     def get_email_campaigns(self):
         """Recupera tutte le campagne email da Brevo (con globalStats)"""
@@ -39,10 +64,11 @@ class BrevoClient:
             url = f"{self.base_url}/emailCampaigns"
             # parametro statistics obbligatorio per avere i globalStats
             params = {"statistics": "globalStats"}
-            response = requests.get(url, headers=self.headers, params=params, timeout=10)
+            response = self.session.get(url, params=params, timeout=10)
             response.raise_for_status()
 
-            data = response.json()
+            # Parse dei bytes grezzi: evita il passaggio da response.text
+            data = _json_loads(response.content)
             campaigns = data.get('campaigns', [])
             print(f"✅ Trovate {len(campaigns)} campagne")
             return campaigns
@@ -55,7 +81,7 @@ class BrevoClient:
         try:
             url = f"{self.base_url}/emailCampaigns/{campaign_id}"
             params = {"statistics": "globalStats"}
-            response = requests.get(url, headers=self.headers, params=params, timeout=10)
+            response = self.session.get(url, params=params, timeout=10)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.RequestException as e:
@@ -63,21 +89,125 @@ class BrevoClient:
             return None
 
 
-def map_brevo_status(status: str) -> str:
-    """Mappa lo stato da Brevo ai valori standard"""
-    status_map = {
-        'draft': 'Draft',
-        'scheduled': 'Scheduled',
-        'queued': 'Sending',
-        'sending': 'Sending',
-        'sent': 'Sent',
-        'paused': 'Paused',
-        'failed': 'Failed',
-        'inProcess': 'Sending',
-        'archive': 'Archived',
-        'suspended': 'Suspended',
-    }
-    return status_map.get(status, status)
+# Mappa stati Brevo -> valori standard (a livello di modulo: costruita una volta sola)
+_STATUS_MAP = {
+    'draft': 'Draft',
+    'scheduled': 'Scheduled',
+    'queued': 'Sending',
+    'sending': 'Sending',
+    'sent': 'Sent',
+    'paused': 'Paused',
+    'failed': 'Failed',
+    'inProcess': 'Sending',
+    'archive': 'Archived',
+    'suspended': 'Suspended',
+}
+
+
+# Metodo .get bound: la mappatura diventa un singolo lookup C con default
+# (chiamare come map_brevo_status(stato, stato))
+map_brevo_status = _STATUS_MAP.get
+
+
+def _pct(num: int, den: int) -> float:
+    """Percentuale a 2 decimali con aritmetica intera (niente round su float)"""
+    return (num * 10000 + den // 2) // den / 100 if den else 0
+
+
+def _iter_rows(campaigns, fieldnames):
+    """Genera le righe CSV come tuple nell'ordine dei fieldnames
+    configurati (la config può riordinare o ridurre le colonne)"""
+    for campaign in campaigns:
+        # --- STATISTICHE ---
+        stats_root = campaign.get('statistics', {})
+        global_stats = stats_root.get('globalStats', {}) or {}
+
+        # Campi corretti da Brevo API
+        sent = int(global_stats.get('sent', 0) or 0)
+        delivered = int(global_stats.get('delivered', 0) or 0)
+        unique_views = int(global_stats.get('uniqueViews', 0) or 0)
+        unique_clicks = int(global_stats.get('uniqueClicks', 0) or 0)
+        soft_bounces = int(global_stats.get('softBounces', 0) or 0)
+        hard_bounces = int(global_stats.get('hardBounces', 0) or 0)
+        unsubscriptions = int(global_stats.get('unsubscriptions', 0) or 0)
+        complaints = int(global_stats.get('complaints', 0) or 0)
+
+        # Calcola tassi percentuali basati su delivered
+        tasso_apertura_pct = _pct(unique_views, delivered)
+        tasso_clic_pct = _pct(unique_clicks, delivered)
+
+        # --- DATE ---
+        created_at = campaign.get('createdAt', '')
+        # scheduledAt è la data di invio pianificata
+        data_invio = campaign.get('scheduledAt', '')
+
+        cid = campaign.get('id', '')
+        stato = campaign.get('status', '')
+        # Mappa nome colonna -> valore: l'ordine di emissione segue i
+        # fieldnames della config, come faceva il DictWriter
+        row = {
+            'id_campagna': cid,
+            'nome_campagna': campaign.get('name', ''),
+            'data_creazione': created_at,
+            'data_invio': data_invio,
+            'stato': map_brevo_status(stato, stato),
+            'sent': sent,
+            'delivered': delivered,
+            'unique_views': unique_views,
+            'unique_clicks': unique_clicks,
+            'tasso_apertura_pct': tasso_apertura_pct,
+            'tasso_clic_pct': tasso_clic_pct,
+            'soft_bounces': soft_bounces,
+            'hard_bounces': hard_bounces,
+            'unsubscriptions': unsubscriptions,
+            'complaints': complaints,
+            'note': campaign.get('subject', ''),
+            'url_campagna': _URL_PREFIX + str(cid),
+        }
+        yield tuple(row.get(name, '') for name in fieldnames)
+
+
+def _write_csv_pandas(campaigns, csv_file, fieldnames):
+    """Percorso vettorizzato (pandas) per liste di campagne molto grandi"""
+
+    df = pd.json_normalize(campaigns, sep='_')
+
+    def col(name, default):
+        if name in df.columns:
+            return df[name].fillna(default)
+        return pd.Series([default] * len(df), index=df.index)
+
+    sent = col('statistics_globalStats_sent', 0).astype('int64')
+    delivered = col('statistics_globalStats_delivered', 0).astype('int64')
+    unique_views = col('statistics_globalStats_uniqueViews', 0).astype('int64')
+    unique_clicks = col('statistics_globalStats_uniqueClicks', 0).astype('int64')
+    soft_bounces = col('statistics_globalStats_softBounces', 0).astype('int64')
+    hard_bounces = col('statistics_globalStats_hardBounces', 0).astype('int64')
+    unsubscriptions = col('statistics_globalStats_unsubscriptions', 0).astype('int64')
+    complaints = col('statistics_globalStats_complaints', 0).astype('int64')
+
+    # Tassi percentuali calcolati in un solo loop C invece che per riga
+    base = delivered.where(delivered > 0, 1)
+    df_out = pd.DataFrame({
+        'id_campagna': col('id', ''),
+        'nome_campagna': col('name', ''),
+        'data_creazione': col('createdAt', ''),
+        'data_invio': col('scheduledAt', ''),
+        'stato': col('status', '').map(lambda s: _STATUS_MAP.get(s, s)),
+        'sent': sent,
+        'delivered': delivered,
+        'unique_views': unique_views,
+        'unique_clicks': unique_clicks,
+        'tasso_apertura_pct': (unique_views * 100 / base).where(delivered > 0, 0).round(2),
+        'tasso_clic_pct': (unique_clicks * 100 / base).where(delivered > 0, 0).round(2),
+        'soft_bounces': soft_bounces,
+        'hard_bounces': hard_bounces,
+        'unsubscriptions': unsubscriptions,
+        'complaints': complaints,
+        'note': col('subject', ''),
+        'url_campagna': _URL_PREFIX + col('id', '').astype(str),
+    })
+    df_out.to_csv(csv_file, index=False, columns=fieldnames)
 
 
 def generate_csv():
@@ -97,57 +227,19 @@ def generate_csv():
         csv_file = CSV_OUTPUT
         fieldnames = CONFIG['csv']['fieldnames']
 
-        with open(csv_file, 'w', newline='', encoding='utf-8') as f:
-
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
-            writer.writeheader()
-
-            for campaign in campaigns:
-                # --- STATISTICHE ---
-                stats_root = campaign.get('statistics', {})
-                global_stats = stats_root.get('globalStats', {}) or {}
-
-                # Campi corretti da Brevo API
-                sent = int(global_stats.get('sent', 0) or 0)
-                delivered = int(global_stats.get('delivered', 0) or 0)
-                unique_views = int(global_stats.get('uniqueViews', 0) or 0)
-                unique_clicks = int(global_stats.get('uniqueClicks', 0) or 0)
-                soft_bounces = int(global_stats.get('softBounces', 0) or 0)
-                hard_bounces = int(global_stats.get('hardBounces', 0) or 0)
-                unsubscriptions = int(global_stats.get('unsubscriptions', 0) or 0)
-                complaints = int(global_stats.get('complaints', 0) or 0)
-
-                # Calcola tassi percentuali basati su delivered
-                base = delivered if delivered > 0 else 1
-                tasso_apertura_pct = round((unique_views / base) * 100, 2) if delivered > 0 else 0
-                tasso_clic_pct = round((unique_clicks / base) * 100, 2) if delivered > 0 else 0
-
-                # --- DATE ---
-                created_at = campaign.get('createdAt', '')
-                # scheduledAt è la data di invio pianificata
-                data_invio = campaign.get('scheduledAt', '')
-
-                row = {
-                    'id_campagna': campaign.get('id', ''),
-                    'nome_campagna': campaign.get('name', ''),
-                    'data_creazione': created_at,
-                    'data_invio': data_invio,
-                    'stato': map_brevo_status(campaign.get('status', '')),
-                    'sent': sent,
-                    'delivered': delivered,
-                    'unique_views': unique_views,
-                    'unique_clicks': unique_clicks,
-                    'tasso_apertura_pct': tasso_apertura_pct,
-                    'tasso_clic_pct': tasso_clic_pct,
-                    'soft_bounces': soft_bounces,
-                    'hard_bounces': hard_bounces,
-                    'unsubscriptions': unsubscriptions,
-                    'complaints': complaints,
-                    'note': campaign.get('subject', ''),
-                    'url_campagna': f"https://app.brevo.com/campaigns/{campaign.get('id', '')}"
-                }
-
-                writer.writerow(row)
+        if pd is not None and len(campaigns) >= _VECTORIZE_THRESHOLD:
+            # Liste grandi: vettorizza il calcolo con pandas
+            _write_csv_pandas(campaigns, csv_file, fieldnames)
+        else:
+            # Compone il CSV in un buffer in memoria e lo scrive su disco
+            # con una singola write (l'output sta sempre in RAM)
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            writer.writerow(fieldnames)
+            writer.writerows(_iter_rows(campaigns, fieldnames))
+
+            with open(csv_file, 'w', newline='', encoding='utf-8') as f:
+                f.write(buf.getvalue())
 
         print(f"✅ CSV generato con successo: {csv_file}")
         print(f"📊 {len(campaigns)} righe scritte")
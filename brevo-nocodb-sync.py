@@ -5,275 +5,678 @@ Script di sincronizzazione Brevo <-> NocoDB
 Importa i dati delle campagne da Brevo e li sincronizza in NocoDB
 """
 
+import hashlib
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import List, Dict, Optional
+import atexit
+import dbm
+import shelve
 import time
 import logging
+import logging.handlers
 
-# Carica configurazione da file
-CONFIG_FILE = '/Users/francesconguyen/brevo-nocodb-config.json'
-with open(CONFIG_FILE, 'r') as f:
-    CONFIG = json.load(f)
+# orjson (parser/serializzatore JSON in C) se disponibile, altrimenti stdlib
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj):
+        return json.dumps(obj).encode()
+
+# Carica configurazione dal modulo condiviso (parse memoizzato)
+from brevo_config import get_config
+
+CONFIG = get_config()
 
 # Sovrascrivi con variabili d'ambiente se disponibili
 CONFIG['brevo']['api_key'] = os.getenv("BREVO_API_KEY", CONFIG['brevo']['fallback_api_key'])
 CONFIG['nocodb']['api_key'] = os.getenv("NOCODB_API_KEY", CONFIG['nocodb']['fallback_api_key'])
 
 # Configura il logger
+# Il FileHandler è avvolto in un MemoryHandler: le righe INFO si accumulano
+# in memoria (un solo write su disco alla fine) e si svuotano subito su ERROR
 LOG_FILE = '/tmp/brevo-nocodb-sync-executions.log'
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+_file_handler = logging.FileHandler(LOG_FILE)
+# Il formatter va impostato sul FileHandler: MemoryHandler.flush() formatta
+# con il formatter del target, non con quello che basicConfig mette sul wrapper
+_file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+_buffered_handler = logging.handlers.MemoryHandler(
+    capacity=10000, flushLevel=logging.ERROR, target=_file_handler)
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
+    format=LOG_FORMAT,
     handlers=[
-        logging.FileHandler(LOG_FILE),
+        _buffered_handler,
         logging.StreamHandler()
     ]
 )
 logger = logging.getLogger(__name__)
 
-class BrevoClient:
+# Garantisce lo svuotamento del buffer di log all'uscita
+atexit.register(_buffered_handler.flush)
+
+# File di stato condiviso tra un run e l'altro (watermark incrementale, ecc.)
+STATE_FILE = '/tmp/brevo-nocodb-state.json'
+
+# Fetch incrementale opt-in (BREVO_INCREMENTAL_FETCH=1): limita il listing
+# alle campagne inviate dopo l'ultimo watermark. Il default resta il fetch
+# completo perché startDate filtra per data di invio: in incrementale le
+# campagne non ancora inviate più vecchie del watermark non vengono più
+# riaggiornate
+INCREMENTAL_FETCH = os.getenv('BREVO_INCREMENTAL_FETCH', '0') == '1'
+
+
+def _load_state() -> Dict:
+    """Carica il file di stato, {} se assente o corrotto"""
+    try:
+        with open(STATE_FILE, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_state(state: Dict) -> None:
+    """Salva il file di stato per il run successivo"""
+    try:
+        with open(STATE_FILE, 'w') as f:
+            json.dump(state, f)
+        # /tmp è leggibile da tutti: lo stato resta privato dell'utente
+        os.chmod(STATE_FILE, 0o600)
+    except OSError as e:
+        logger.warning("⚠️  Impossibile scrivere lo stato: %s", e)
+
+
+def _update_state(**fields) -> None:
+    """Aggiorna singole chiavi dello stato senza perdere le altre"""
+    state = _load_state()
+    state.update(fields)
+    _save_state(state)
+
+
+class _HttpClient:
+    """Base comune dei client HTTP: Session con pooling e retry automatici"""
+
+    def __init__(self, headers: Dict):
+        self.headers = headers
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        retry = Retry(total=5, backoff_factor=0.5,
+                      status_forcelist=[429, 500, 502, 503, 504],
+                      respect_retry_after_header=True)
+        self.session.mount('https://', HTTPAdapter(
+            pool_connections=10, pool_maxsize=10, max_retries=retry))
+
+    def _request_with_backoff(self, method: str, url: str, max_attempts: int = 5,
+                              **kwargs) -> requests.Response:
+        """Richiesta con backoff adattivo sui 429 (l'adapter Retry non
+        copre POST/PATCH): attende quanto chiede il server via Retry-After,
+        altrimenti backoff esponenziale"""
+        delay = 0.5
+        response = self.session.request(method, url, **kwargs)
+
+        for _ in range(max_attempts - 1):
+            if response.status_code != 429:
+                break
+            try:
+                # Retry-After può essere anche una data HTTP: in quel caso
+                # (o se assente) si ripiega sul backoff esponenziale
+                wait = float(response.headers.get('Retry-After', delay))
+            except ValueError:
+                wait = delay
+            logger.info("  ⏳ Rate limit raggiunto, attendo %ss...", wait)
+            time.sleep(wait)
+            delay *= 2
+            response = self.session.request(method, url, **kwargs)
+
+        return response
+
+
+class BrevoClient(_HttpClient):
     def __init__(self, api_key: str):
         self.api_key = api_key
         self.base_url = CONFIG['brevo']['api_url']
-        self.headers = {
+        super().__init__({
             'api-key': api_key,
             'Content-Type': 'application/json'
-        }
+        })
+        # Risposte compresse: il listing campagne è il payload più grande
+        self.session.headers['Accept-Encoding'] = 'gzip'
 
-    def get_email_campaigns(self) -> List[Dict]:
-        """Recupera tutte le campagne email da Brevo con statistiche globali"""
-        print("📧 Recuperando campagne da Brevo...")
+    # Campagne per pagina del listing
+    PAGE_SIZE = 100
+
+    def get_email_campaigns(self, since: Optional[str] = None) -> List[Dict]:
+        """Recupera le campagne email da Brevo con statistiche globali,
+        paginando; con `since` limita alle campagne inviate dopo quella
+        data (startDate di Brevo filtra per data di invio)"""
+        logger.info("📧 Recuperando campagne da Brevo...")
 
         try:
             url = f"{self.base_url}/emailCampaigns"
-            params = {"statistics": "globalStats"}
-            response = requests.get(url, headers=self.headers, params=params, timeout=30)
-            response.raise_for_status()
+            campaigns = []
+            offset = 0
+
+            while True:
+                params = {"statistics": "globalStats",
+                          "limit": self.PAGE_SIZE, "offset": offset}
+                if since:
+                    params["startDate"] = since
+
+                # stream=True + raw.read: un solo buffer di bytes, senza la
+                # copia interna di requests né il decode a str
+                with self.session.get(url, params=params, timeout=30, stream=True) as response:
+                    response.raise_for_status()
+                    body = response.raw.read(decode_content=True)
 
-            campaigns = response.json().get('campaigns', [])
-            print(f"✅ Trovate {len(campaigns)} campagne")
+                page = _json_loads(body).get('campaigns', [])
+                campaigns.extend(page)
+
+                if len(page) < self.PAGE_SIZE:
+                    break
+                offset += self.PAGE_SIZE
+
+            logger.info("✅ Trovate %d campagne", len(campaigns))
             return campaigns
         except requests.exceptions.RequestException as e:
-            print(f"❌ Errore nel recupero campagne Brevo: {e}")
+            logger.error("❌ Errore nel recupero campagne Brevo: %s", e)
             raise
 
-    def get_campaign_details(self, campaign_id: int) -> Optional[Dict]:
-        """Ottiene i dettagli di una campagna specifica"""
-        try:
-            url = f"{self.base_url}/emailCampaigns/{campaign_id}"
-            response = requests.get(url, headers=self.headers, timeout=10)
-            response.raise_for_status()
-            return response.json()
-        except requests.exceptions.RequestException as e:
-            print(f"⚠️  Errore nel recupero dettagli campagna {campaign_id}: {e}")
-            return None
 
+class NocODBClient(_HttpClient):
+    # Numero di record per singola richiesta di inserimento bulk
+    BATCH_SIZE = 100
+
+    # Concorrenza massima degli update (cap per rispettare i rate limit)
+    MAX_PARALLEL_UPDATES = 10
+
+    # Cache su disco dei record esistenti {id_campagna: record}, per
+    # saltare il fetch nei run ravvicinati
+    CACHE_FILE = '/tmp/brevo-nocodb-existing.json'
+    CACHE_TTL = 600  # secondi
+
+    # Validità della verifica tabella memorizzata nello state file: entro
+    # questo intervallo verify_table salta il probe iniziale
+    VERIFY_TTL = 86400  # secondi
 
-class NocODBClient:
     def __init__(self, api_key: str, table_url: str):
         self.api_key = api_key
         self.table_url = table_url
         # Usa Authorization: Bearer (xc-auth non funziona con questo token)
-        self.headers = {
+        super().__init__({
             'Authorization': f'Bearer {api_key}',
             'Content-Type': 'application/json'
-        }
+        })
+        # True se l'ultimo get_existing_campaigns_dict ha risposto da cache
+        self._dict_from_cache = False
+        # True dopo il primo tentativo di ri-verifica su 401 (una sola volta)
+        self._reverified_after_401 = False
+        # False se la tabella non ha la colonna sync_hash: i payload non
+        # devono includerla (delta sync disattivato)
+        self._has_sync_hash = True
+        # Prefisso precomputato dell'URL dei singoli record
+        self._record_url_prefix = table_url + '/'
+
+    def _load_cached_records(self) -> Optional[Dict]:
+        """Carica la cache su disco se ancora fresca, altrimenti None"""
+        try:
+            if time.time() - os.path.getmtime(self.CACHE_FILE) < self.CACHE_TTL:
+                with open(self.CACHE_FILE, 'r') as f:
+                    return json.load(f)
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def save_records_cache(self, records: Dict) -> None:
+        """Salva la mappa {id_campagna: record} su disco per i run successivi"""
+        try:
+            with open(self.CACHE_FILE, 'w') as f:
+                json.dump(records, f)
+        except OSError as e:
+            logger.warning("⚠️  Impossibile scrivere la cache: %s", e)
+
+    def invalidate_cache(self) -> None:
+        """Elimina la cache su disco (es. dopo un inserimento fallito)"""
+        try:
+            os.remove(self.CACHE_FILE)
+        except OSError:
+            pass
 
     def get_existing_campaign_ids(self) -> set:
         """Recupera gli ID delle campagne già sincronizzate"""
-        print("📋 Recuperando IDs delle campagne già sincronizzate...")
+        # Se la cache su disco è fresca, evita del tutto il round-trip
+        cached = self._load_cached_records()
+        if cached is not None:
+            logger.info("📋 Usando la cache (%d campagne già sincronizzate)", len(cached))
+            return set(cached)
 
-        try:
-            # Recupera tutti i record (con limite alto per essere sicuri)
-            url = f"{self.table_url}?limit=1000"
-            response = requests.get(url, headers=self.headers, timeout=10)
+        logger.info("📋 Recuperando IDs delle campagne già sincronizzate...")
 
-            if response.status_code == 200:
-                data = response.json()
-                campaign_ids = {str(record.get('id_campagna')) for record in data.get('list', [])}
-                print(f"✅ Trovate {len(campaign_ids)} campagne già sincronizzate")
-                return campaign_ids
-            else:
-                print(f"⚠️  Non posso recuperare i record esistenti (status {response.status_code})")
-                return set()
+        try:
+            # Pagina i risultati chiedendo solo il campo id_campagna:
+            # meno byte sulla rete e corretto anche oltre 1000 record
+            campaign_ids = set()
+            offset = 0
+            while True:
+                params = {'fields': 'id_campagna', 'limit': 500, 'offset': offset}
+                response = self.session.get(self.table_url, params=params, timeout=10)
+
+                if response.status_code != 200:
+                    logger.warning("⚠️  Non posso recuperare i record esistenti (status %s)", response.status_code)
+                    return set()
+
+                data = _json_loads(response.content)
+                campaign_ids.update(str(record.get('id_campagna')) for record in data.get('list', []))
+
+                if data.get('pageInfo', {}).get('isLastPage', True):
+                    break
+                offset += 500
+
+            logger.info("✅ Trovate %d campagne già sincronizzate", len(campaign_ids))
+            return campaign_ids
         except Exception as e:
-            print(f"⚠️  Errore nel recupero record: {e}")
+            logger.warning("⚠️  Errore nel recupero record: %s", e)
             return set()
 
     def get_existing_campaigns_dict(self) -> Dict:
         """Recupera tutti i record esistenti come dict con id_campagna come chiave"""
-        print("📋 Recuperando campagne dal database...")
-
-        try:
-            # Recupera tutti i record (con limite alto per essere sicuri)
-            url = f"{self.table_url}?limit=1000"
-            response = requests.get(url, headers=self.headers, timeout=10)
-
-            if response.status_code == 200:
-                data = response.json()
-                # Crea un dict con id_campagna come chiave
-                campaigns_dict = {
-                    str(record.get('id_campagna')): record
-                    for record in data.get('list', [])
-                }
-                print(f"✅ Trovate {len(campaigns_dict)} campagne nel database")
-                return campaigns_dict
-            else:
-                print(f"⚠️  Non posso recuperare i record esistenti (status {response.status_code})")
-                return {}
-        except Exception as e:
-            print(f"⚠️  Errore nel recupero record: {e}")
-            return {}
+        # Se la cache su disco è fresca, evita del tutto il round-trip
+        cached = self._load_cached_records()
+        if cached is not None:
+            self._dict_from_cache = True
+            # Se nessun record in cache ha sync_hash, il fetch originale
+            # era avvenuto senza la colonna: delta sync resta disattivato
+            if cached and not any('sync_hash' in r for r in cached.values()):
+                self._has_sync_hash = False
+            logger.info("📋 Usando la cache (%d campagne nel database)", len(cached))
+            return cached
+
+        self._dict_from_cache = False
+        logger.info("📋 Recuperando campagne dal database...")
+
+        # Pagina i risultati chiedendo solo le colonne effettivamente
+        # lette: corretto oltre 1000 record e molti meno byte sulla rete.
+        # La colonna sync_hash (delta sync) è opzionale: se la tabella non
+        # ce l'ha NocoDB rifiuta il fields=, quindi si riparte senza
+        # (gli update verranno inviati senza confronto hash)
+        fields = 'Id,id_campagna,stato,sync_hash'
+        campaigns_dict = {}
+        offset = 0
+        while True:
+            params = {'fields': fields, 'limit': 200, 'offset': offset}
+            response = self.session.get(self.table_url, params=params, timeout=10)
+
+            if response.status_code != 200:
+                if 'sync_hash' in fields:
+                    logger.warning("⚠️  Fetch con sync_hash rifiutato (status %s): riprovo senza (delta sync disattivato)", response.status_code)
+                    self._has_sync_hash = False
+                    fields = 'Id,id_campagna,stato'
+                    campaigns_dict = {}
+                    offset = 0
+                    continue
+                # Tornare {} farebbe sembrare la tabella vuota e
+                # reinserirebbe ogni campagna come duplicato: meglio
+                # interrompere il run
+                raise RuntimeError(
+                    f"Impossibile recuperare i record esistenti (status {response.status_code})")
+
+            data = _json_loads(response.content)
+            # Crea un dict con id_campagna come chiave
+            for record in data.get('list', []):
+                campaigns_dict[str(record.get('id_campagna'))] = record
+
+            if data.get('pageInfo', {}).get('isLastPage', True):
+                break
+            offset += 200
+
+        logger.info("✅ Trovate %d campagne nel database", len(campaigns_dict))
+        return campaigns_dict
 
     def verify_table(self) -> bool:
         """Verifica che la tabella sia accessibile"""
-        print("🔍 Verificando accesso alla tabella NocoDB...")
+        # Verifica memorizzata nello state file: entro il TTL salta il probe.
+        # Dello stato fa parte solo l'URL senza query e un flag per il
+        # fallback ?nc=: il token si ricostruisce dalla chiave corrente,
+        # così la API key non finisce mai su disco
+        state = _load_state()
+        plain_url = self.table_url.split('?', 1)[0]
+        if (time.time() - state.get('table_verified_at', 0) < self.VERIFY_TTL
+                and state.get('table_url') == plain_url):
+            if state.get('table_nc_fallback'):
+                self.table_url = f"{plain_url}?nc={self.api_key}"
+            self._record_url_prefix = self.table_url + '/'
+            logger.info("🔍 Tabella verificata di recente (state file), salto il controllo")
+            return True
+
+        # Cache fresca = la tabella era accessibile poco fa: salta il probe
+        if self._load_cached_records() is not None:
+            logger.info("🔍 Tabella verificata di recente (cache fresca), salto il controllo")
+            return True
+
+        logger.info("🔍 Verificando accesso alla tabella NocoDB...")
 
         try:
-            # Prova con il token nel header
-            response = requests.get(self.table_url, headers=self.headers, timeout=10)
+            # Prova con il token nel header (URL senza query: una
+            # ri-verifica può partire da un table_url già col fallback)
+            response = self.session.get(plain_url, timeout=10)
 
             if response.status_code == 200:
-                print(f"✅ Tabella accessibile (via header)")
+                self.table_url = plain_url
+                self._record_url_prefix = plain_url + '/'
+                _update_state(table_url=plain_url, table_nc_fallback=False,
+                              table_verified_at=time.time())
+                logger.info("✅ Tabella accessibile (via header)")
                 return True
             elif response.status_code == 401:
                 # Prova con token come query parameter
-                print("⚠️  Token nel header non valido, provo con query parameter...")
-                url_with_token = f"{self.table_url}?nc={self.api_key}"
-                response = requests.get(url_with_token, timeout=10)
+                logger.warning("⚠️  Token nel header non valido, provo con query parameter...")
+                url_with_token = f"{plain_url}?nc={self.api_key}"
+                response = self.session.get(url_with_token, timeout=10)
 
                 if response.status_code == 200:
                     # Aggiorna l'URL per i prossimi inserimenti
                     self.table_url = url_with_token
-                    print(f"✅ Tabella accessibile (via query parameter)")
+                    self._record_url_prefix = url_with_token + '/'
+                    _update_state(table_url=plain_url, table_nc_fallback=True,
+                                  table_verified_at=time.time())
+                    logger.info("✅ Tabella accessibile (via query parameter)")
                     return True
                 else:
-                    print(f"❌ Errore di accesso: {response.status_code}")
+                    logger.error("❌ Errore di accesso: %s", response.status_code)
                     return False
             else:
-                print(f"❌ Errore di accesso: {response.status_code}")
+                logger.error("❌ Errore di accesso: %s", response.status_code)
                 return False
         except requests.exceptions.RequestException as e:
-            print(f"❌ Errore nel verificare la tabella: {e}")
+            logger.error("❌ Errore nel verificare la tabella: %s", e)
             return False
 
+    def _request_with_backoff(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Come la base, ma su un 401 dimentica la verifica memorizzata,
+        riesegue verify_table una volta e ritenta con l'URL aggiornato"""
+        response = super()._request_with_backoff(method, url, **kwargs)
+
+        if response.status_code == 401 and not self._reverified_after_401:
+            self._reverified_after_401 = True
+            logger.warning("⚠️  401 durante le operazioni: riverifico la tabella...")
+            old_table_url = self.table_url
+            old_prefix = self._record_url_prefix
+            _update_state(table_verified_at=0)
+            self.invalidate_cache()
+
+            if self.verify_table():
+                # verify_table può aver riscritto table_url (fallback ?nc=)
+                if url == old_table_url:
+                    url = self.table_url
+                elif url.startswith(old_prefix):
+                    url = self._record_url_prefix + url[len(old_prefix):]
+                response = super()._request_with_backoff(method, url, **kwargs)
+
+        return response
+
     def update_record(self, record_id, record_data: Dict) -> bool:
         """Aggiorna un record esistente in NocoDB"""
         try:
             # L'endpoint per update è: /tables/{table_id}/records/{record_id}
             # record_id è il valore del campo 'Id' di NocoDB
-            url = f"{self.table_url}/{record_id}"
-            response = requests.patch(url, headers=self.headers, json=record_data, timeout=10)
+            url = self._record_url_prefix + str(record_id)
+            # Serializza con _json_dumps (orjson se installato): il
+            # Content-Type è già negli header della session
+            response = self._request_with_backoff(
+                'PATCH', url, data=_json_dumps(record_data), timeout=10)
 
             if response.status_code in [200, 201]:
                 return True
             else:
-                print(f"  ⚠️  Errore nell'aggiornamento record {record_id}: {response.status_code} - {response.text[:100]}")
+                logger.warning("  ⚠️  Errore nell'aggiornamento record %s: %s - %s", record_id, response.status_code, response.text[:100])
                 return False
         except requests.exceptions.RequestException as e:
-            print(f"  ❌ Errore nell'aggiornamento record: {e}")
+            logger.error("  ❌ Errore nell'aggiornamento record: %s", e)
             return False
 
-    def insert_records(self, records: List[Dict]) -> None:
-        """Inserisce i record nella tabella"""
-        print(f"💾 Inserendo {len(records)} campagne in NocoDB...")
+    def _post_batch(self, batch: List[Dict]) -> requests.Response:
+        """Invia un batch di record gestendo i 429 con backoff"""
+        # Serializza con _json_dumps (orjson se installato): il Content-Type
+        # è già impostato negli header della session
+        return self._request_with_backoff(
+            'POST', self.table_url, data=_json_dumps(batch), timeout=30)
+
+    def insert_records(self, records: List[Dict]) -> bool:
+        """Inserisce i record nella tabella a batch (bulk insert).
+        Ritorna True solo se ogni batch è andato a buon fine"""
+        logger.info("💾 Inserendo %d campagne in NocoDB...", len(records))
+        ok = True
 
         try:
-            for idx, record in enumerate(records, 1):
+            # Alias locali per il loop (LOAD_FAST invece di lookup di attributo)
+            batch_size = self.BATCH_SIZE
+            total_batches = (len(records) + batch_size - 1) // batch_size
+
+            for batch_idx in range(total_batches):
+                batch = records[batch_idx * batch_size:(batch_idx + 1) * batch_size]
+
                 try:
-                    # Invia il record così com'è (NocoDB accetta None per valori vuoti)
-                    response = requests.post(self.table_url, headers=self.headers, json=record, timeout=10)
+                    # L'endpoint /records accetta un array JSON per il bulk insert
+                    response = self._post_batch(batch)
 
                     if response.status_code in [200, 201]:
-                        print(f"  ✅ [{idx}/{len(records)}] {record.get('nome_campagna', 'N/A')} (NEW)")
+                        logger.info("  ✅ [batch %d/%d] %d campagne inserite (NEW)", batch_idx + 1, total_batches, len(batch))
                     elif response.status_code == 403:
                         # Prova senza i campi Currency e calcolati
-                        simplified_record = {
+                        simplified_batch = [{
                             'id_campagna': record.get('id_campagna'),
                             'nome_campagna': record.get('nome_campagna'),
                             'data_creazione': record.get('data_creazione'),
                             'data_invio': record.get('data_invio'),
                             'stato': record.get('stato'),
                             'num_contatti': record.get('num_contatti'),
-                        }
-                        response = requests.post(self.table_url, headers=self.headers, json=simplified_record, timeout=10)
+                        } for record in batch]
+                        response = self._post_batch(simplified_batch)
 
                         if response.status_code in [200, 201]:
-                            print(f"  ✅ [{idx}/{len(records)}] {record.get('nome_campagna', 'N/A')} (NEW - formato semplificato)")
+                            logger.info("  ✅ [batch %d/%d] %d campagne inserite (NEW - formato semplificato)", batch_idx + 1, total_batches, len(batch))
                         else:
-                            print(f"  ⚠️  [{idx}/{len(records)}] {record.get('nome_campagna', 'N/A')} - Errore: {response.status_code}")
+                            logger.warning("  ⚠️  [batch %d/%d] Errore: %s", batch_idx + 1, total_batches, response.status_code)
                             # Debug: stampa il primo errore 403
-                            if idx == 2:
-                                print(f"     Debug response: {response.text[:200]}")
+                            if batch_idx == 0:
+                                logger.warning("     Debug response: %s", response.text[:200])
+                            self.invalidate_cache()
+                            ok = False
                     else:
-                        print(f"  ⚠️  [{idx}/{len(records)}] {record.get('nome_campagna', 'N/A')} - Errore: {response.status_code}")
+                        logger.warning("  ⚠️  [batch %d/%d] Errore: %s", batch_idx + 1, total_batches, response.status_code)
+                        self.invalidate_cache()
+                        ok = False
                 except requests.exceptions.RequestException as e:
-                    print(f"  ❌ [{idx}/{len(records)}] Errore inserimento: {e}")
+                    logger.error("  ❌ [batch %d/%d] Errore inserimento: %s", batch_idx + 1, total_batches, e)
+                    self.invalidate_cache()
+                    ok = False
 
-                time.sleep(0.2)  # Rate limiting
+            return ok
 
         except Exception as e:
-            print(f"❌ Errore nell'inserimento dati: {e}")
+            logger.error("❌ Errore nell'inserimento dati: %s", e)
+            self.invalidate_cache()
             raise
 
-    def sync_records(self, new_records: List[Dict], updates: List[tuple]) -> None:
-        """Sincronizza i record: inserisce i nuovi e aggiorna gli esistenti"""
+    def _update_one(self, item: tuple) -> bool:
+        """Aggiorna un singolo record, senza propagare eccezioni"""
+        record_id, record_data = item
+        try:
+            return self.update_record(record_id, record_data)
+        except Exception as e:
+            logger.error("  ❌ Errore aggiornamento: %s", e)
+            return False
+
+    def update_records(self, updates: List[tuple]) -> bool:
+        """Aggiorna i record esistenti a batch (bulk PATCH con chiave 'Id').
+        Ritorna True solo se ogni record è stato aggiornato"""
+        logger.info("🔄 Aggiornando %d campagne in NocoDB...", len(updates))
+        ok = True
+
+        # Alias locali per il loop (LOAD_FAST invece di lookup di attributo)
+        batch_size = self.BATCH_SIZE
+        total_batches = (len(updates) + batch_size - 1) // batch_size
+
+        for batch_idx in range(total_batches):
+            chunk = updates[batch_idx * batch_size:(batch_idx + 1) * batch_size]
+            # Il bulk update di NocoDB usa il campo 'Id' dentro ogni record
+            payload = [{'Id': record_id, **record_data} for record_id, record_data in chunk]
+
+            try:
+                response = self._request_with_backoff(
+                    'PATCH', self.table_url, data=_json_dumps(payload), timeout=30)
+
+                if response.status_code in [200, 201]:
+                    logger.info("  ✅ [batch %d/%d] %d campagne aggiornate (UPDATE)", batch_idx + 1, total_batches, len(chunk))
+                    continue
+
+                logger.warning("  ⚠️  [batch %d/%d] Bulk update fallito (%s), riprovo per singolo record...", batch_idx + 1, total_batches, response.status_code)
+            except requests.exceptions.RequestException as e:
+                logger.error("  ❌ [batch %d/%d] Errore aggiornamento bulk: %s", batch_idx + 1, total_batches, e)
+
+            # Fallback: aggiorna i record del batch uno a uno
+            if not self._update_records_fallback(chunk):
+                ok = False
+
+        return ok
+
+    def _update_records_fallback(self, updates: List[tuple]) -> bool:
+        """Aggiorna i record uno a uno in parallelo (fallback del bulk).
+        Ritorna True solo se ogni aggiornamento è riuscito"""
+        ok = True
+        with ThreadPoolExecutor(max_workers=self.MAX_PARALLEL_UPDATES) as executor:
+            results = executor.map(self._update_one, updates)
+
+            for idx, ((_, record_data), success) in enumerate(zip(updates, results), 1):
+                if success:
+                    logger.info("  ✅ [%d/%d] %s (UPDATE)", idx, len(updates), record_data.get('nome_campagna', 'N/A'))
+                else:
+                    logger.warning("  ⚠️  [%d/%d] %s - Errore nell'aggiornamento", idx, len(updates), record_data.get('nome_campagna', 'N/A'))
+                    ok = False
+        return ok
+
+    def sync_records(self, new_records: List[Dict], updates: List[tuple]) -> bool:
+        """Sincronizza i record: inserisce i nuovi e aggiorna gli esistenti.
+        Ritorna True solo se ogni batch è andato a buon fine"""
+        ok = True
+
         # Inserisce i nuovi record
         if new_records:
-            self.insert_records(new_records)
+            ok = self.insert_records(new_records) and ok
 
         # Aggiorna i record esistenti
         if updates:
-            print(f"🔄 Aggiornando {len(updates)} campagne in NocoDB...")
-            for idx, (record_id, record_data) in enumerate(updates, 1):
-                try:
-                    success = self.update_record(record_id, record_data)
-                    if success:
-                        print(f"  ✅ [{idx}/{len(updates)}] {record_data.get('nome_campagna', 'N/A')} (UPDATE)")
-                    else:
-                        print(f"  ⚠️  [{idx}/{len(updates)}] {record_data.get('nome_campagna', 'N/A')} - Errore nell'aggiornamento")
-                except Exception as e:
-                    print(f"  ❌ [{idx}/{len(updates)}] Errore aggiornamento: {e}")
-
-                time.sleep(0.2)  # Rate limiting
-
-
-def map_brevo_status(status: str) -> str:
-    """Mappa lo stato da Brevo ai valori standard"""
-    status_map = {
-        'draft': 'Draft',
-        'scheduled': 'Scheduled',
-        'queued': 'Sending',
-        'sending': 'Sending',
-        'sent': 'Sent',
-        'paused': 'Paused',
-        'failed': 'Failed'
-    }
-    return status_map.get(status, status)
+            ok = self.update_records(updates) and ok
+
+        return ok
+
+
+# Mappa stati Brevo -> valori standard (a livello di modulo: costruita una volta sola)
+_STATUS_MAP = {
+    'draft': 'Draft',
+    'scheduled': 'Scheduled',
+    'queued': 'Sending',
+    'sending': 'Sending',
+    'sent': 'Sent',
+    'paused': 'Paused',
+    'failed': 'Failed'
+}
+
+
+# Metodo .get bound: la mappatura diventa un singolo lookup C con default
+# (chiamare come map_brevo_status(stato, stato))
+map_brevo_status = _STATUS_MAP.get
+
+
+# Costanti riusate nel loop di trasformazione (evita allocazioni per riga)
+_EMPTY = {}
+_URL_PREFIX = "https://app.brevo.com/campaigns/"
+
+
+def _pct(num: int, den: int) -> float:
+    """Percentuale a 2 decimali con aritmetica intera (niente round su float)"""
+    return (num * 10000 + den // 2) // den / 100 if den else 0
+
+
+def _sync_hash(record: Dict) -> str:
+    """Hash breve e stabile del record trasformato (delta sync)"""
+    payload = json.dumps(record, sort_keys=True).encode()
+    return hashlib.blake2b(payload, digest_size=8).hexdigest()
+
+
+# Memo su disco delle trasformazioni: nei run di cron la stessa campagna
+# viene ritrasformata identica finché Brevo non la tocca. Chiave
+# (id, modifiedAt): l'invalidazione è implicita perché modifiedAt cambia
+# a ogni modifica lato Brevo
+TRANSFORM_CACHE_FILE = '/tmp/brevo-transform.cache'
+
+
+def _open_transform_cache():
+    """Apre la cache shelve; su file corrotto (dbm.error, es. run
+    sovrapposti) la scarta e riprova, altrimenti None = nessuna cache"""
+    for _ in range(2):
+        try:
+            cache = shelve.open(TRANSFORM_CACHE_FILE)
+            atexit.register(cache.close)
+            return cache
+        except (dbm.error, OSError):
+            try:
+                os.remove(TRANSFORM_CACHE_FILE)
+            except OSError:
+                return None
+    return None
+
+
+_transform_cache = _open_transform_cache()
 
 
 def transform_campaign_data(campaign: Dict) -> Dict:
-    """Trasforma i dati della campagna Brevo nel formato NocoDB"""
+    """Trasforma i dati della campagna Brevo nel formato NocoDB
+    (memoizzato su disco per (id, modifiedAt) quando disponibile)"""
+    modified_at = campaign.get('modifiedAt')
+    if _transform_cache is None or not modified_at:
+        # Senza modifiedAt non c'è chiave di invalidazione affidabile
+        return _transform_campaign_data(campaign)
+
+    key = f"{campaign.get('id')}:{modified_at}"
+    cached = _transform_cache.get(key)
+    if cached is not None:
+        return cached
+
+    record = _transform_campaign_data(campaign)
+    _transform_cache[key] = record
+    return record
 
-    stats_root = campaign.get('statistics', {})
-    global_stats = stats_root.get('globalStats', {}) or {}
+
+def _transform_campaign_data(campaign: Dict) -> Dict:
+    """Costruisce il record NocoDB a partire dalla campagna Brevo"""
+
+    # Alias locali: riduce i lookup ripetuti nel percorso caldo
+    g = campaign.get
+    global_stats = (g('statistics') or _EMPTY).get('globalStats') or _EMPTY
+    gs = global_stats.get
 
     # Campi corretti da Brevo API
-    delivered = int(global_stats.get('delivered', 0) or 0)
-    unique_views = int(global_stats.get('uniqueViews', 0) or 0)
-    unique_clicks = int(global_stats.get('uniqueClicks', 0) or 0)
+    delivered = int(gs('delivered') or 0)
+    unique_views = int(gs('uniqueViews') or 0)
+    unique_clicks = int(gs('uniqueClicks') or 0)
 
     # Calcola tassi percentuali basati su delivered
-    base = delivered if delivered > 0 else 1
-    tasso_apertura_pct = round((unique_views / base) * 100, 2) if delivered > 0 else 0
-    tasso_clic_pct = round((unique_clicks / base) * 100, 2) if delivered > 0 else 0
+    tasso_apertura_pct = _pct(unique_views, delivered)
+    tasso_clic_pct = _pct(unique_clicks, delivered)
 
     # Estrai sender direttamente da Brevo (campo 'sender' della campagna)
     # Brevo ritorna il valore di sender come dict con i dettagli del mittente
-    sender_field = campaign.get('sender')
+    sender_field = g('sender')
     sender = None
 
     if sender_field:
@@ -285,22 +688,24 @@ def transform_campaign_data(campaign: Dict) -> Dict:
             sender = str(sender_field)
 
     # Mappa al formato della tabella NocoDB
+    cid = g('id', '')
+    stato = g('status', 'unknown')
     return {
-        'id_campagna': str(campaign.get('id', '')),
-        'nome_campagna': campaign.get('name', 'N/A'),
-        'data_creazione': campaign.get('createdAt'),
-        'data_invio': campaign.get('scheduledAt'),
+        'id_campagna': str(cid),
+        'nome_campagna': g('name', 'N/A'),
+        'data_creazione': g('createdAt'),
+        'data_invio': g('scheduledAt'),
         'data_fine': None,
-        'stato': map_brevo_status(campaign.get('status', 'unknown')),
+        'stato': map_brevo_status(stato, stato),
         'num_contatti': delivered,
         'tasso_apertura_pct': tasso_apertura_pct,
         'tasso_clic_pct': tasso_clic_pct,
         'num_conversioni': None,
         'budget': None,
         'roi_pct': None,
-        'note': campaign.get('subject', ''),
+        'note': g('subject', ''),
         'sender': sender,
-        'url_campagna': f"https://app.brevo.com/campaigns/{campaign.get('id', '')}"
+        'url_campagna': _URL_PREFIX + str(cid)
     }
 
 
@@ -308,101 +713,143 @@ def sync_brevo_to_nocodb():
     """Funzione principale di sincronizzazione"""
     logger.info("="*80)
     logger.info("🚀 Avviando sincronizzazione Brevo -> NocoDB")
-    print("🚀 Avviando sincronizzazione Brevo -> NocoDB\n")
 
     try:
-        # 1. Ottenere le campagne da Brevo
+        state = _load_state()
         brevo = BrevoClient(CONFIG['brevo']['api_key'])
-        all_campaigns = brevo.get_email_campaigns()
 
-        if not all_campaigns:
-            logger.warning("⚠️  Nessuna campagna trovata in Brevo")
-            print("⚠️  Nessuna campagna trovata in Brevo")
-            return
-
-        logger.info(f"✅ Trovate {len(all_campaigns)} campagne da Brevo")
-
-        # 2. Connettere a NocoDB
+        # 1. Connettere a NocoDB
         table_id = CONFIG['nocodb']['table_id']
         table_url = f"{CONFIG['nocodb']['api_url']}/tables/{table_id}/records"
         nocodb = NocODBClient(CONFIG['nocodb']['api_key'], table_url)
 
-        # 3. Verificare accesso alla tabella
+        # 2. Verificare accesso alla tabella
         if not nocodb.verify_table():
             logger.error("❌ Impossibile accedere alla tabella NocoDB")
-            print("❌ Impossibile accedere alla tabella NocoDB")
             exit(1)
 
-        # 4. Recuperare tutti i record esistenti dal database (come dict)
-        existing_campaigns = nocodb.get_existing_campaigns_dict()
+        # 3. Le due GET iniziali (campagne da Brevo, incrementale dal
+        # watermark, e record esistenti da NocoDB) colpiscono host diversi
+        # e non dipendono l'una dall'altra: in parallelo il tempo è quello
+        # della più lenta, non la somma
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            campaigns_future = executor.submit(
+                brevo.get_email_campaigns,
+                state.get('last_sent_at') if INCREMENTAL_FETCH else None)
+            existing_future = executor.submit(nocodb.get_existing_campaigns_dict)
+            all_campaigns = campaigns_future.result()
+            existing_campaigns = existing_future.result()
 
-        # 5. Separare le campagne da Brevo in nuove e da aggiornare:
+        if not all_campaigns:
+            logger.warning("⚠️  Nessuna campagna trovata in Brevo")
+            return
+
+        logger.info("✅ Trovate %d campagne da Brevo", len(all_campaigns))
+
+        # 4. Separare le campagne da Brevo in nuove e da aggiornare:
         #    - NUOVE: non presenti in existing_campaigns
         #    - AGGIORNAMENTO: presenti in existing_campaigns E status ≠ 'Sent'
-        new_campaigns = []
-        campaigns_to_update = []
+        # Un solo passaggio che produce direttamente i record trasformati:
+        # le campagne 'Sent' già sincronizzate non vengono mai trasformate
+        new_records = []
+        updates = []
+        unchanged = 0
+        get_existing = existing_campaigns.get
+        transform = transform_campaign_data
+        # Senza la colonna sync_hash i payload non devono includerla
+        # (NocoDB rifiuta i campi sconosciuti) e ogni update viene inviato
+        has_sync_hash = nocodb._has_sync_hash
 
         for campaign in all_campaigns:
-            campaign_id = str(campaign.get('id'))
-            if campaign_id not in existing_campaigns:
-                # Campagna nuova
-                new_campaigns.append(campaign)
+            existing = get_existing(str(campaign.get('id')))
+            if existing is None:
+                # Campagna nuova: include l'hash per i confronti futuri
+                record = transform(campaign)
+                if has_sync_hash:
+                    record['sync_hash'] = _sync_hash(record)
+                new_records.append(record)
             elif campaign.get('status') != 'sent':
-                # Campagna esistente ma non in stato "Sent" → aggiornamento necessario
-                campaigns_to_update.append((campaign_id, campaign))
+                # Campagna esistente ma non in stato "Sent" → aggiornamento
+                # solo se il contenuto è effettivamente cambiato (delta sync)
+                record = transform(campaign)
+                if has_sync_hash:
+                    record_hash = _sync_hash(record)
+                    if record_hash == existing.get('sync_hash'):
+                        unchanged += 1
+                        continue
+                    record['sync_hash'] = record_hash
+                # Nota: NocoDB usa 'Id' (con I maiuscola) come campo identificativo
+                updates.append((existing['Id'], record))
+
+        if unchanged:
+            logger.info("⏭️  Campagne invariate (hash identico), nessun PATCH: %d", unchanged)
 
         # Se nulla da fare, esci
-        if not new_campaigns and not campaigns_to_update:
-            logger.info(f"ℹ️  Nessuna campagna da sincronizzare")
-            logger.info(f"📊 Tutte le {len(all_campaigns)} campagne sono già sincronizzate e in stato 'Sent'")
-            print("\n✨ Nessuna campagna da sincronizzare")
-            print(f"📊 Tutte le {len(all_campaigns)} campagne sono già sincronizzate e in stato 'Sent'")
+        if not new_records and not updates:
+            logger.info("ℹ️  Nessuna campagna da sincronizzare")
+            logger.info("📊 Tutte le %d campagne sono già sincronizzate e in stato 'Sent'", len(all_campaigns))
+            # Scalda comunque la cache se i dati venivano dal server
+            if not nocodb._dict_from_cache:
+                nocodb.save_records_cache(existing_campaigns)
+            # Avanza il watermark per il fetch incrementale opt-in:
+            # chiave sulla data di invio, la stessa su cui filtra startDate
+            sent_dates = [c.get('sentDate') or c.get('scheduledAt')
+                          for c in all_campaigns
+                          if c.get('sentDate') or c.get('scheduledAt')]
+            if sent_dates:
+                _update_state(last_sent_at=max(sent_dates))
             return
 
         # Log delle operazioni
-        if new_campaigns:
-            logger.info(f"📥 Nuove campagne da inserire: {len(new_campaigns)}")
-            print(f"\n📥 Nuove campagne: {len(new_campaigns)}")
-
-        if campaigns_to_update:
-            logger.info(f"🔄 Campagne da aggiornare (non in stato 'Sent'): {len(campaigns_to_update)}")
-            print(f"🔄 Campagne da aggiornare: {len(campaigns_to_update)}")
-
-        total = len(new_campaigns) + len(campaigns_to_update)
-        logger.info(f"📥 Totale operazioni: {total} su {len(all_campaigns)}")
-        print(f"📥 Totale operazioni: {total} su {len(all_campaigns)}")
-
-        # 6. Trasformare i dati e sincronizzare
-        # Trasforma i nuovi record
-        new_records = [transform_campaign_data(campaign) for campaign in new_campaigns]
-
-        # Trasforma i record da aggiornare (mantenendo record_id)
-        # Nota: NocoDB usa 'Id' (con I maiuscola) come campo identificativo
-        updates = [
-            (existing_campaigns[campaign_id]['Id'], transform_campaign_data(campaign))
-            for campaign_id, campaign in campaigns_to_update
-        ]
-
-        # Sincronizza (insert + update)
-        nocodb.sync_records(new_records, updates)
-
-        logger.info(f"✨ Sincronizzazione completata con SUCCESSO")
-        logger.info(f"📊 {len(new_campaigns)} nuove campagne sincronizzate")
-        logger.info(f"🔄 {len(campaigns_to_update)} campagne aggiornate")
-        logger.info(f"📈 Totale campagne nel database: {len(all_campaigns)}")
-        logger.info("STATUS: ✅ OK")
-        logger.info("="*80 + "\n")
+        if new_records:
+            logger.info("📥 Nuove campagne da inserire: %d", len(new_records))
 
-        print("\n✨ Sincronizzazione completata!")
-        print(f"📊 {len(new_campaigns)} nuove campagne sincronizzate")
-        print(f"🔄 {len(campaigns_to_update)} campagne aggiornate")
-        print(f"📈 Totale campagne nel database: {len(all_campaigns)}")
+        if updates:
+            logger.info("🔄 Campagne da aggiornare (non in stato 'Sent'): %d", len(updates))
+
+        total = len(new_records) + len(updates)
+        logger.info("📥 Totale operazioni: %d su %d", total, len(all_campaigns))
+
+        # 5. Sincronizzare (insert + update)
+        sync_ok = nocodb.sync_records(new_records, updates)
+
+        # Aggiorna la cache su disco con lo stato post-sincronizzazione.
+        # Gli insert (e qualunque batch fallito) la invalidano; gli update
+        # vengono fusi nei record esistenti. Se i dati venivano già dalla
+        # cache e nulla è cambiato, non riscrivere il file per non
+        # estendere il TTL all'infinito.
+        if new_records or not sync_ok:
+            nocodb.invalidate_cache()
+        elif updates or not nocodb._dict_from_cache:
+            merged = dict(existing_campaigns)
+            for record_id, rec in updates:
+                merged[rec['id_campagna']] = {**merged.get(rec['id_campagna'], {}), **rec, 'Id': record_id}
+            nocodb.save_records_cache(merged)
+
+        # Avanza il watermark (fetch incrementale opt-in, chiave sulla data
+        # di invio come startDate) solo se ogni batch è riuscito: una
+        # campagna il cui insert è fallito resterebbe altrimenti esclusa
+        # per sempre dai fetch incrementali successivi
+        if sync_ok:
+            sent_dates = [c.get('sentDate') or c.get('scheduledAt')
+                          for c in all_campaigns
+                          if c.get('sentDate') or c.get('scheduledAt')]
+            if sent_dates:
+                _update_state(last_sent_at=max(sent_dates))
+        else:
+            logger.warning("⚠️  Alcuni batch non sono riusciti: watermark non avanzato, i record verranno ritentati al prossimo run")
+
+        logger.info("✨ Sincronizzazione completata con SUCCESSO")
+        logger.info("📊 %d nuove campagne sincronizzate", len(new_records))
+        logger.info("🔄 %d campagne aggiornate", len(updates))
+        logger.info("📈 Totale campagne nel database: %d", len(all_campaigns))
+        logger.info("STATUS: ✅ OK")
+        logger.info("=" * 80 + "\n")
 
     except Exception as e:
-        logger.error(f"❌ Sincronizzazione fallita: {e}")
+        logger.error("❌ Sincronizzazione fallita: %s", e)
         logger.error("STATUS: ❌ FALLITO")
-        logger.error("="*80 + "\n")
-        print(f"\n❌ Sincronizzazione fallita: {e}")
+        logger.error("=" * 80 + "\n")
         exit(1)
 
 
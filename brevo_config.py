@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+
+"""
+Caricamento condiviso della configurazione Brevo/NocoDB
+Il file JSON viene letto e parsato una sola volta per processo
+"""
+
+import json
+from functools import lru_cache
+from pathlib import Path
+
+# orjson (parser JSON in C) se disponibile, altrimenti stdlib
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+CONFIG_FILE = '/Users/francesconguyen/brevo-nocodb-config.json'
+
+
+@lru_cache(maxsize=1)
+def get_config() -> dict:
+    """Carica (e memoizza) la configurazione da CONFIG_FILE"""
+    return _json_loads(Path(CONFIG_FILE).read_bytes())